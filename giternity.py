@@ -19,78 +19,141 @@ giternity - Mirror git repositories and retrieve metadata for cgit
 """
 
 import argparse
+import hashlib
 import os
+import pickle
 import re
 import subprocess
 import sys
+import threading
+import time
 import logging as log
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import exists, join
 from subprocess import run
 
+from cachecontrol import CacheControlAdapter
+from cachecontrol.caches.file_cache import FileCache
 from colors import color
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import toml
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    import json
+
+    def json_loads(data: bytes):
+        # json.loads() only accepts bytes from Python 3.6
+        return json.loads(data.decode("utf-8"))
+
 
 __version__ = "0.4.0"
 
 
-def mirror(url: str, path: str):
+_NEXT_RE = re.compile(r'<[^>]+[?&]page=(\d+)>; rel="next"')
+_LAST_RE = re.compile(r'<[^>]+[?&]page=(\d+)>; rel="last"')
+
+
+def mirror(url: str, path: str, depth: int = None, pushed_at: str = None,
+           partial: bool = False):
+    web_dir = join(path, "info", "web")
+    pushed_at_file = join(web_dir, "pushed-at")
+
+    # GitHub tells us when the repo was last pushed to, skip the fetch if
+    # we already mirrored that push
+    if pushed_at and exists(pushed_at_file):
+        with open(pushed_at_file) as f:
+            if f.read().strip() == pushed_at:
+                log.debug("Skipping unchanged %s", url)
+                return True
+
     if exists(path):
-        run(["git", "-C", path, "remote", "update", "--prune"],
-            stdout=subprocess.DEVNULL)
+        update = run(["git", "-C", path, "remote", "update", "--prune"],
+                     stdout=subprocess.DEVNULL)
     else:
-        run(["git", "clone", "--bare", "--mirror", url, path],
-            stdout=subprocess.DEVNULL)
+        shallow = ["--depth", str(depth)] if depth else []
+        # later updates reuse the filter, git records it in the repo config
+        blobless = ["--filter=blob:none"] if partial else []
+        update = run(["git", "clone", "--bare", "--mirror"]
+                     + shallow + blobless + [url, path],
+                     stdout=subprocess.DEVNULL)
 
-    web_dir = join(path, "info", "web")
+    if update.returncode != 0:
+        log.error("Mirroring %s to %s failed", url, path)
+        return False
 
     os.makedirs(web_dir, exist_ok=True)
 
-    # set last modified date
+    # set last modified date, from the branches like cgit does without an
+    # agefile
     date = run(["git", "-C", path,
                 "for-each-ref",
                 "--sort=-authordate",
                 "--count=1",
-                "--format='%(authordate:iso8601)'"],
+                "--format=%(authordate:iso8601)",
+                "refs/heads"],
                stdout=subprocess.PIPE)
 
     with open(join(web_dir, "last-modified"), "wb") as f:
         f.write(date.stdout)
 
+    if pushed_at:
+        with open(pushed_at_file, "w") as f:
+            f.write(pushed_at)
+    return True
+
+
+def is_partial_clone(path: str):
+    # packs fetched from a promisor remote come with a .promisor file
+    try:
+        return any(name.endswith(".promisor")
+                   for name in os.listdir(join(path, "objects", "pack")))
+    except OSError:
+        return False
+
 
 def clone(source: str, destination: str):
+    # a copy of a partial clone lacks the blobs, and can't fetch them lazily
+    # because upload-pack in the mirror doesn't fetch from its own promisor
+    if is_partial_clone(source):
+        log.warning("Not checking out partial clone %s", source)
+        return False
+
     if is_work_tree(destination):
-        run(["git", "-C", destination, "pull"],
-            stdout=subprocess.DEVNULL)
+        result = run(["git", "-C", destination, "pull"],
+                     stdout=subprocess.DEVNULL)
+    elif exists(destination):
+        # e.g. a bare copy left by older versions, which can't be pulled
+        log.error("Not checking out %s, %s exists and isn't a work tree",
+                  source, destination)
+        return False
     else:
-        run(["git", "clone", "--bare", source, destination],
-            stdout=subprocess.DEVNULL)
+        result = run(["git", "clone", source, destination],
+                     stdout=subprocess.DEVNULL)
 
+    if result.returncode != 0:
+        log.error("Checking out %s to %s failed", source, destination)
+        return False
+    return True
 
-def is_bare_repo(path: str):
-    is_git = run(["git", "-C", path, "rev-parse", "--is-bare-repository"],
-                 stdout=subprocess.PIPE,
-                 stderr=subprocess.DEVNULL)\
-                 .stdout\
-                 .strip()
 
-    return is_git == b"true"
+def _is_bare_listing(entries: dict):
+    """Whether a directory's scandir entries, by name, make a bare repo."""
+    return ("HEAD" in entries and entries["HEAD"].is_file()
+            and "objects" in entries and entries["objects"].is_dir()
+            and "refs" in entries and entries["refs"].is_dir())
 
 
 def is_work_tree(path: str):
-    is_work = run(["git", "-C", path, "rev-parse", "--is-inside-work-tree"],
-                  stdout=subprocess.PIPE,
-                  stderr=subprocess.DEVNULL)\
-                  .stdout\
-                  .strip()
-
-    return is_work == b"true"
+    return os.path.isdir(join(path, ".git"))
 
 
 class GitHub:
-    def __init__(self, cgit_url=None, token=None):
+    def __init__(self, cgit_url=None, token=None, cache_path=None):
         session = requests.Session()
         session.headers.update({
             "Accept": "application/vnd.github.v3+json",
@@ -100,65 +163,150 @@ class GitHub:
             session.headers.update({
                 "Authorization": "token %s" % token,
             })
+        # keep enough connections alive for concurrent requests
+        pool = dict(pool_connections=32, pool_maxsize=32,
+                    max_retries=Retry(total=3, backoff_factor=0.5,
+                                      status_forcelist=[502, 503, 504]))
+        if cache_path:
+            # GitHub sends an ETag with every response, revalidating with it
+            # returns 304 without counting against the rate limit
+            adapter = CacheControlAdapter(cache=FileCache(cache_path), **pool)
+        else:
+            adapter = HTTPAdapter(**pool)
+        session.mount("https://", adapter)
         self.s = session
         self.api = "https://api.github.com"
         self.cgit_url = cgit_url
+        self._ratelimit_lock = threading.Lock()
+        self._ratelimit_remaining = None
+        self._ratelimit_reset = 0
+        self._inflight = 0
+
+    def _get(self, url: str):
+        with self._ratelimit_lock:
+            # wait for the rate limit to reset rather than get 403s, other
+            # threads are held up by the lock meanwhile
+            if (self._ratelimit_remaining is not None
+                    and self._ratelimit_remaining <= self._inflight):
+                delay = self._ratelimit_reset - time.time()
+                if delay > 0:
+                    log.warning("GitHub rate limit reached, "
+                                "waiting %d seconds", delay)
+                    time.sleep(delay)
+                self._ratelimit_remaining = None
+            self._inflight += 1
+        try:
+            result = self.s.get(url)
+        finally:
+            with self._ratelimit_lock:
+                self._inflight -= 1
+
+        if (not getattr(result, "from_cache", False)
+                and "X-RateLimit-Remaining" in result.headers):
+            with self._ratelimit_lock:
+                self._ratelimit_remaining = \
+                    int(result.headers["X-RateLimit-Remaining"])
+                self._ratelimit_reset = \
+                    int(result.headers.get("X-RateLimit-Reset", 0))
+        return result
 
     def get_repo(self, owner: str, repository: str):
-        return self.s.get(self.api + "/repos/{}/{}".format(owner, repository))\
-                     .json()
+        result = self._get(self.api + "/repos/{}/{}"
+                           .format(owner, repository))
+        return json_loads(result.content)
 
     def get_repos(self, user: str):
-        # FIXME (arrdem 2018-07-01):
-        #   while next_page ...
-        (data, next_page) = self.get_repos_page(user, 1)
-        while next_page:
-            (d, next_page) = self.get_repos_page(user, next_page)
-            data += d
-        data = [r for r in data if not r["fork"]]
+        (first, next_page, last_page) = self.get_repos_page(user, 1)
+        data = [r for r in first if not r["fork"]]
+        if last_page:
+            # GitHub told us how many pages there are, fetch them all at once
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                pages = executor.map(
+                    lambda page: self.get_repos_page(user, page)[0],
+                    range(2, last_page + 1))
+                for d in pages:
+                    data.extend(r for r in d if not r["fork"])
+        else:
+            while next_page:
+                (d, next_page, _) = self.get_repos_page(user, next_page)
+                data.extend(r for r in d if not r["fork"])
         return data
 
     def get_repos_page(self, user: str, page: int):
-        result = self.s.get("{}/users/{}/repos?per_page=100&page={}"
-                            .format(self.api, user, page))
-        link_header = "Link" in result.headers and\
-                      re.search('<[^>]+page=(\d+)>; rel="next"',
-                                str(result.headers["Link"]))
-        next_page = link_header and int(link_header.groups()[0])
-        return (result.json(), next_page)
-
-    def repo_to_cgitrc(self, data):
+        result = self._get("{}/users/{}/repos?per_page=100&page={}"
+                           .format(self.api, user, page))
+        link = result.headers.get("Link", "")
+        next_link = 'rel="next"' in link and _NEXT_RE.search(link)
+        next_page = next_link and int(next_link.group(1))
+        last_link = 'rel="last"' in link and _LAST_RE.search(link)
+        last_page = last_link and int(last_link.group(1))
+        return (json_loads(result.content), next_page, last_page)
+
+    def repo_to_cgitrc(self, data, local: bool = True):
+        # plain concatenation, giternity still supports Python 3.5
         cgitrc = []
-        if self.cgit_url:
-            local_url = self.cgit_url + data["full_name"]
-            clone_url = "clone-url={} {}\n".format(local_url, data["clone_url"])
+        if data.get("homepage"):
+            cgitrc.append("homepage=" + data["homepage"] + "\n")
 
+        if self.cgit_url and local:
+            local_url = self.cgit_url + data["full_name"]
+            cgitrc.append("clone-url=" + local_url + " "
+                          + data["clone_url"] + "\n")
         else:
-            clone_url = "clone-url={}\n".format(data["clone_url"])
+            cgitrc.append("clone-url=" + data["clone_url"] + "\n")
 
-        if data["description"]:
-            desc = "desc={}\n".format(data["description"].replace("\n", ""))
+        description = data.get("description")
+        if description:
+            cgitrc.append("desc=" + description.replace("\n", "") + "\n")
         else:
-            desc = "desc=Mysterious Project\n"
-
-        if data["homepage"]:
-            homepage = "homepage={}\n".format(data["homepage"])
-            cgitrc.append(homepage)
+            cgitrc.append("desc=Mysterious Project\n")
 
-        name = "name={}\n".format(data["name"])
-        cgitrc += [clone_url, desc, name]
+        cgitrc.append("name=" + data["name"] + "\n")
         return "".join(cgitrc)
 
 
 def find_repos(git_data_path: str, checkout_path: str):
-    for entry in os.scandir(git_data_path):
-        if entry.is_dir():
-            if is_bare_repo(entry.git_data_path):
-                clone(entry.git_data_path,
-                      entry.git_data_path.replace(git_data_path,
-                                                  checkout_path))
-            else:
-                find_repos(entry.git_data_path)
+    """Yield (source, destination) pairs for every bare repo to check out."""
+    stack = [git_data_path]
+    while stack:
+        path = stack.pop()
+        # one listing per directory both identifies repos and finds subdirs
+        entries = {entry.name: entry for entry in os.scandir(path)}
+        if path != git_data_path and _is_bare_listing(entries):
+            yield (path, path.replace(git_data_path, checkout_path, 1))
+            continue
+        for entry in entries.values():
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+
+
+def load_config(path: str):
+    """Load the TOML configuration, reusing a pickled copy if unchanged."""
+    # parse from a single string, toml.load() reads the file piecemeal
+    with open(path, "rb") as f:
+        data = f.read()
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size, hashlib.sha256(data).hexdigest())
+    cache = path + ".cache.pickle"
+    try:
+        with open(cache, "rb") as f:
+            (cached_key, config) = pickle.load(f)
+        if cached_key == key and isinstance(config, dict):
+            return config
+    except Exception:
+        # a missing, unreadable or malformed cache is just a cache miss
+        pass
+
+    config = toml.loads(data.decode("utf-8"))
+    try:
+        # the config holds the GitHub token, keep the cache owner-only
+        fd = os.open(cache, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            os.fchmod(f.fileno(), 0o600)
+            pickle.dump((key, config), f)
+    except OSError:
+        log.debug("Could not write configuration cache %s", cache)
+    return config
 
 
 _LOG_LEVEL_STRINGS = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"]
@@ -211,7 +359,7 @@ def main():
                     format='%(name)-12s: %(levelname)-8s %(message)s')
 
     try:
-        config = toml.load(args.config_file)
+        config = load_config(args.config_file)
     except FileNotFoundError:
         print(color("No configuration file found!", fg="red"))
         print("Please place your configuration at "
@@ -222,6 +370,10 @@ def main():
     checkout_path = config.get("checkout_path")
     cgit_url = config.get("cgit_url")
     checkout_suffix = config.get("checkout_suffix", "")
+    cache_path = config.get("cache_path")
+    jobs = config.get("jobs", 16)
+    clone_depth = config.get("clone_depth")
+    partial_clone = config.get("partial_clone", False)
 
     # The plan for what to archive and where it will go
     archive_plan = []
@@ -230,7 +382,14 @@ def main():
     if gh_config:
         repos = gh_config.get("repositories", [])
         token = gh_config.get("token")
-        gh_api = GitHub(cgit_url=cgit_url, token=token)
+        gh_api = GitHub(cgit_url=cgit_url, token=token,
+                        cache_path=cache_path)
+
+        # Repos of owners that are also listed as a whole are looked up in
+        # that listing, which is fetched anyway, instead of one by one
+        users = {addr.lower() for addr in repos if "/" not in addr}
+        listings = {}
+        by_name = {}
 
         # FIXME (arrdem 2018-06-20):
         #   Can this loop be cleaned up at all?
@@ -241,13 +400,26 @@ def main():
                             "{}{}".format(addr, checkout_suffix))
                 owner, name = addr.split("/")
                 url = "https://github.com/{}/{}.git".format(owner, name)
-                repo = gh_api.get_repo(owner, name)
+                key = owner.lower()
+                if key in users and key not in listings:
+                    listings[key] = gh_api.get_repos(owner)
+                    by_name.update((r["full_name"].lower(), r)
+                                   for r in listings[key])
+                repo = by_name.get(addr.lower())
+                if repo is None:
+                    # forks and private repos aren't in the listing
+                    repo = gh_api.get_repo(owner, name)
                 metadata = gh_api.repo_to_cgitrc(repo)
                 archive_plan.append((repo, metadata, url, path))
 
             else:
                 log.debug("Fetching user/group %s", addr)
-                for repo in gh_api.get_repos(addr):
+                key = addr.lower()
+                if key not in listings:
+                    listings[key] = gh_api.get_repos(addr)
+                    by_name.update((r["full_name"].lower(), r)
+                                   for r in listings[key])
+                for repo in listings[key]:
                     path = join(git_data_path, "{}{}"
                                 .format(repo["full_name"],
                                         checkout_suffix))
@@ -268,22 +440,48 @@ def main():
             metadata = gh_api.repo_to_cgitrc(repo)
             archive_plan.append((repo, metadata, url, path))
 
+    # The same repo can be planned twice (e.g. "alice" and "alice/proj"),
+    # mirroring it concurrently into one path would race
+    planned = set()
+    unique_plan = []
+    for entry in archive_plan:
+        if entry[3] not in planned:
+            planned.add(entry[3])
+            unique_plan.append(entry)
+    archive_plan = unique_plan
+
     if args.dry_run:
         for repo, metadata, url, path in archive_plan:
             print("""%s (%s) -> %s""" % (repo["full_name"], url, path))
 
     else:
         log.info("Mirroring repositories...")
-        for repo, metadata, url, path in archive_plan:
-            mirror(url, path)
-            # FIXME (arrdem 2018-07-01):
-            #   Slurp existing cgitrc and merge with it?
-            with open(join(path, "cgitrc"), "w") as f:
-                f.write(metadata)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(mirror, url, path, clone_depth,
+                                       repo.get("pushed_at"), partial_clone):
+                       (repo, metadata, path)
+                       for repo, metadata, url, path in archive_plan}
+            for future in as_completed(futures):
+                repo, metadata, path = futures[future]
+                # one failed mirror shouldn't stop the others getting cgitrc
+                if not future.result() or not exists(path):
+                    continue
+                if cgit_url and is_partial_clone(path):
+                    # cloning from a partial mirror fails, don't advertise it
+                    metadata = gh_api.repo_to_cgitrc(repo, local=False)
+                # FIXME (arrdem 2018-07-01):
+                #   Slurp existing cgitrc and merge with it?
+                with open(join(path, "cgitrc"), "w") as f:
+                    f.write(metadata)
 
         if checkout_path:
             log.info("Checking out repositories to %s" % checkout_path)
-            find_repos(git_data_path, checkout_path)
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(clone, source, destination)
+                           for source, destination
+                           in find_repos(git_data_path, checkout_path)]
+                for future in as_completed(futures):
+                    future.result()
 
 
 if __name__ == "__main__":
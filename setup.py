@@ -24,7 +24,9 @@ setup(
 
     python_requires=">=3.5",
     py_modules=["giternity"],
-    install_requires=["ansicolors", "requests", "toml"],
+    install_requires=["ansicolors", "cachecontrol[filecache]", "requests",
+                      "toml", "urllib3"],
+    extras_require={"fast": ["orjson"]},
     entry_points={"console_scripts": ["giternity=giternity:main"]},
 
     author="Rahiel Kasim",